@@ -3,6 +3,7 @@ import pandas as pd
 import json
 import gspread
 import hashlib
+import threading
 from google.oauth2.service_account import Credentials
 
 # --- APP CONFIG ---
@@ -100,6 +101,98 @@ def load_data(sheet_name):
     except Exception:
         return []
 
+# --- CONCURRENCY CONTROL ---
+# Streamlit serves every browser session from the same process, so a shared
+# registry lets us serialize writes per occasion and stamp each one with a
+# version. A session only writes if the version it loaded is still current.
+class ConflictError(Exception):
+    pass
+
+@st.cache_resource
+def get_occasion_registry():
+    return {"guard": threading.Lock(), "locks": {}, "versions": {}}
+
+def get_occasion_lock(occasion):
+    reg = get_occasion_registry()
+    with reg["guard"]:
+        return reg["locks"].setdefault(occasion, threading.Lock())
+
+def get_occasion_version(occasion):
+    reg = get_occasion_registry()
+    with reg["guard"]:
+        return reg["versions"].get(occasion, 0)
+
+def bump_occasion_version(occasion):
+    reg = get_occasion_registry()
+    with reg["guard"]:
+        reg["versions"][occasion] = reg["versions"].get(occasion, 0) + 1
+        return reg["versions"][occasion]
+
+def write_occasion(occasion, write_fn, expected_version=None):
+    # Compare-and-swap: run write_fn only if nobody wrote since expected_version.
+    # Pass expected_version=None for writes that are safe to apply on top of
+    # others (e.g. appending a new expense).
+    with get_occasion_lock(occasion):
+        if expected_version is not None and get_occasion_version(occasion) != expected_version:
+            raise ConflictError("This occasion was changed by someone else.")
+        write_fn(get_worksheet(occasion))
+        return bump_occasion_version(occasion)
+
+def reload_expenses(occasion):
+    # Read the version first so a concurrent write makes our copy look stale
+    st.session_state.expenses_version = get_occasion_version(occasion)
+    st.session_state.expenses = load_data(occasion)
+
+def row_matches(values, expected):
+    # Verify the sheet row still holds the entry we think it does
+    if len(values) < 4:
+        return False
+    try:
+        same_amount = abs(float(values[2]) - float(expected['Amount'])) < 0.005
+    except (TypeError, ValueError):
+        return False
+    return (str(values[1]) == str(expected['Item'])
+            and str(values[3]) == str(expected['Payer'])
+            and same_amount)
+
+def delete_expense_row(sheet, idx, expected):
+    row_num = idx + 2  # +2 for 0-based index and header row
+    # Unformatted so currency/thousands formatting doesn't break the comparison
+    values = sheet.row_values(row_num, value_render_option='UNFORMATTED_VALUE')
+    if not row_matches(values, expected):
+        raise ConflictError("That entry has moved or was already removed.")
+    sheet.delete_rows(row_num)
+
+def row_snapshot(row):
+    # Fields delete_expense_row checks against, captured when the button renders
+    return {"Item": row['Item'], "Amount": row['Amount'], "Payer": row['Payer']}
+
+def run_occasion_write(occasion, write_fn, expected_version, success_msg):
+    # Button callback: Streamlit runs it before the script body, so
+    # expected_version is the one the user saw, not one refreshed by this rerun
+    try:
+        write_occasion(occasion, write_fn, expected_version)
+        st.session_state.flash_msg = ("success", success_msg)
+    except ConflictError as e:
+        st.session_state.flash_msg = ("warning", f"⚠️ {e} Data has been refreshed, please try again.")
+    reload_expenses(occasion)
+
+def delete_entry_cb(occasion, expected_version, idx, expected, success_msg):
+    run_occasion_write(occasion,
+                       lambda sheet: delete_expense_row(sheet, idx, expected),
+                       expected_version, success_msg)
+
+def mark_paid_cb(occasion, expected_version, settlement_row):
+    run_occasion_write(occasion,
+                       lambda sheet: sheet.append_row(settlement_row),
+                       expected_version, "Saved!")
+
+def reset_sheet_cb(occasion, expected_version, headers):
+    def reset_sheet(sheet):
+        sheet.clear()
+        sheet.append_row(headers)
+    run_occasion_write(occasion, reset_sheet, expected_version, "Sheet reset!")
+
 # Define your families and their specific members
 if 'families' not in st.session_state:
     # Try loading from the "Families" sheet
@@ -251,8 +344,11 @@ if user_role == "Admin":
         if st.button("Confirm Delete", key="del_occ_btn"):
             try:
                 sh = get_spreadsheet()
-                ws = get_worksheet(selected_occasion)
-                sh.del_worksheet(ws)
+                with get_occasion_lock(selected_occasion):
+                    ws = get_worksheet(selected_occasion)
+                    sh.del_worksheet(ws)
+                    # Bump rather than clear so stale sessions can't match a re-created sheet
+                    bump_occasion_version(selected_occasion)
                 st.success("Deleted!")
                 if 'current_occasion' in st.session_state:
                     del st.session_state.current_occasion
@@ -262,8 +358,11 @@ if user_role == "Admin":
 
 # Load data for the selected occasion
 # We use a session_state variable to track if we need to reload
-if 'current_occasion' not in st.session_state or st.session_state.current_occasion != selected_occasion:
-    st.session_state.expenses = load_data(selected_occasion)
+# Also reload when another session has written to this occasion since we loaded
+if ('current_occasion' not in st.session_state
+        or st.session_state.current_occasion != selected_occasion
+        or st.session_state.get('expenses_version') != get_occasion_version(selected_occasion)):
+    reload_expenses(selected_occasion)
     st.session_state.current_occasion = selected_occasion
 
 # Add New Occasion
@@ -296,6 +395,11 @@ else:
     tab_users = None
 
 with tab_expenses:
+    if 'flash_msg' in st.session_state:
+        kind, msg = st.session_state.flash_msg
+        getattr(st, kind)(msg)
+        del st.session_state.flash_msg
+
     # --- MAIN UI: Add Expense ---
     with st.expander("➕ Add New Expense", expanded=True):
         col1, col2 = st.columns(2)
@@ -348,17 +452,18 @@ with tab_expenses:
             
             row_data = [session_name, item, amount, payer_fam, split_type, families_json, attendees_json]
             
-            sheet = get_worksheet(selected_occasion)
-            
-            # If sheet is empty, add headers first
-            if len(sheet.get_all_values()) == 0:
-                sheet.append_row(["Session", "Item", "Amount", "Payer", "Split", "Families", "Attendees"])
+            def add_row(sheet):
+                # If sheet is empty, add headers first
+                if len(sheet.get_all_values()) == 0:
+                    sheet.append_row(["Session", "Item", "Amount", "Payer", "Split", "Families", "Attendees"])
+                sheet.append_row(row_data)
             
-            sheet.append_row(row_data)
+            # Appends don't clash with other writes, so no version check here
+            write_occasion(selected_occasion, add_row)
             
             st.success(f"Added: {item}")
             # Rerun to reload data from sheet
-            st.session_state.expenses = load_data(selected_occasion)
+            reload_expenses(selected_occasion)
             st.rerun()
         else:
             st.error("Please fill all fields and select participating families.")
@@ -376,12 +481,8 @@ with tab_expenses:
         if not set(required_cols).issubset(all_df.columns):
             st.error("⚠️ Data Error: The Google Sheet is missing required headers.")
             st.info("This happens if data was added before the headers were created.")
-            if st.button("🛠️ Fix Sheet (Reset & Add Headers)"):
-                sheet = get_worksheet(selected_occasion)
-                sheet.clear()
-                sheet.append_row(required_cols)
-                st.session_state.expenses = load_data(selected_occasion)
-                st.rerun()
+            st.button("🛠️ Fix Sheet (Reset & Add Headers)", on_click=reset_sheet_cb,
+                      args=(selected_occasion, st.session_state.expenses_version, required_cols))
             st.stop()
 
         df = all_df.copy() # The loaded data is already specific to this occasion/sheet
@@ -451,12 +552,9 @@ with tab_expenses:
                 for index, row in settlements_df.iterrows():
                     c1, c2 = st.columns([4, 1])
                     c1.write(f"✅ {row['Item']} - **${row['Amount']}**")
-                    if c2.button("Revert", key=f"rev_{index}"):
-                        sheet = get_worksheet(selected_occasion)
-                        sheet.delete_rows(index + 2)  # +2 accounts for 0-based index and header row
-                        st.success("Settlement reverted!")
-                        st.session_state.expenses = load_data(selected_occasion)
-                        st.rerun()
+                    c2.button("Revert", key=f"rev_{index}", on_click=delete_entry_cb,
+                              args=(selected_occasion, st.session_state.expenses_version,
+                                    index, row_snapshot(row), "Settlement reverted!"))
             
             # Logic to calculate who pays whom (Greedy Algorithm)
             debtors = []
@@ -487,13 +585,12 @@ with tab_expenses:
                     settlements_found = True
                     c1, c2 = st.columns([3, 1])
                     c1.markdown(f"👉 **{debtor['fam']}** pays **{creditor['fam']}**: `${amount:.2f}`")
-                    if c2.button("Mark as Paid", key=f"pay_{i}_{j}"):
-                        sheet = get_worksheet(selected_occasion)
-                        # Record settlement: Payer=Debtor, Split=Equal among [Creditor]
-                        sheet.append_row([session_name, f"Settlement: {debtor['fam']} -> {creditor['fam']}", round(amount, 2), debtor['fam'], "By Family (Equal)", json.dumps([creditor['fam']]), ""])
-                        st.success("Saved!")
-                        st.session_state.expenses = load_data(selected_occasion)
-                        st.rerun()
+                    # Record settlement: Payer=Debtor, Split=Equal among [Creditor]
+                    settlement_row = [session_name, f"Settlement: {debtor['fam']} -> {creditor['fam']}", round(amount, 2), debtor['fam'], "By Family (Equal)", json.dumps([creditor['fam']]), ""]
+                    # The row and version are bound at render time, so a click on a
+                    # plan someone else already settled is rejected as a conflict
+                    c2.button("Mark as Paid", key=f"pay_{i}_{j}", on_click=mark_paid_cb,
+                              args=(selected_occasion, st.session_state.expenses_version, settlement_row))
                 
                 # Adjust remaining amounts
                 debtor['amount'] -= amount
@@ -562,12 +659,9 @@ with tab_expenses:
                         st.markdown(" | ".join(breakdown))
                     
                     # Delete Action
-                    if st.button("🗑️ Delete Entry", key=f"del_log_{idx}"):
-                        sheet = get_worksheet(selected_occasion)
-                        sheet.delete_rows(idx + 2) # +2 for 1-based index and header
-                        st.success("Deleted!")
-                        st.session_state.expenses = load_data(selected_occasion)
-                        st.rerun()
+                    st.button("🗑️ Delete Entry", key=f"del_log_{idx}", on_click=delete_entry_cb,
+                              args=(selected_occasion, st.session_state.expenses_version,
+                                    idx, row_snapshot(row), "Deleted!"))
         else:
             st.info("No expenses in this session.")
 